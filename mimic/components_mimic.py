@@ -6,7 +6,10 @@ import random
 import numpy as np
 import pandas as pd
 import seaborn as sns
+import tensorflow as tf
 from matplotlib import pyplot as plt
+from numba import njit
+from scipy import sparse
 from sklearn.model_selection import train_test_split
 from tensorflow import keras, test
 
@@ -176,6 +179,29 @@ class pse_helper_functions:
 	def pse_a(self, x):
 		return x
 
+	# input (a 2 columns object array of active meds and departments, built
+	# row by row so that numpy does not try to make the lists a dimension.)
+	def pse_array(self, active_meds, depas):
+		x = np.empty((len(active_meds), 2), dtype=object)
+		for i, (active_med, depa) in enumerate(zip(active_meds, depas)):
+			x[i, 0] = active_med
+			x[i, 1] = depa
+		return x
+
+
+@njit
+def pad_ids(flat_ids, lengths, offsets, out):
+	# Compiled with numba, copies the embedding ids of each sequence
+	# (concatenated in flat_ids) at the end of its row of out, keeping
+	# only the last ids of sequences that are too long and filling the
+	# beginning of the row with the padding id 0, like pad_sequences.
+	sequence_length = out.shape[1]
+	for i in range(lengths.shape[0]):
+		n = min(lengths[i], sequence_length)
+		start = offsets[i] + lengths[i] - n
+		out[i, :sequence_length - n] = 0
+		out[i, sequence_length - n:] = flat_ids[start:start + n]
+
 
 class TransformedGenerator(keras.utils.Sequence):
 
@@ -206,6 +232,13 @@ class TransformedGenerator(keras.utils.Sequence):
 		# Do you want the targets ? True if you're training or evaluating,
 		# False if you're predicting
 		self.return_targets = return_targets
+		# Build the embedding matrix from the word2vec vocabulary.
+		# Row 0 is reserved for padding and medications absent from the
+		# vocabulary, which are transformed into a zeros array.
+		wv = self.w2v.gensim_model.wv
+		self.embedding_matrix = np.zeros((len(wv.index2entity) + 1, self.w2v_embedding_dim), dtype=np.float32)
+		self.embedding_matrix[1:] = wv.vectors
+		self.token2id = {medic: i + 1 for i, medic in enumerate(wv.index2entity)}
 
 	def __len__(self):
 		# Required by tensorflow, compute the length of the generator
@@ -213,39 +246,59 @@ class TransformedGenerator(keras.utils.Sequence):
 		return int(np.ceil(len(self.X_w2v) / float(self.batch_size)))
 
 	def __getitem__(self, idx):
+		# Get the indices of the samples in the batch, then transform them
+		batch_indices = range(idx * self.batch_size, min((idx+1) * self.batch_size, len(self.X_w2v)))
+		return self.transform(batch_indices)
+
+	def transform(self, batch_indices):
 		# Transformation happens here.
 		# Features go into a dict
 		X = dict()
-		# Transform the sequence into word2vec embeddings
-		# Get a batch
-		batch_w2v = self.X_w2v[idx * self.batch_size:(idx+1) * self.batch_size]
-		# Transform if medication is in word2vec vocab, otherwize a zeros array shaped like word2vec embeddings
-		transformed_w2v = [[self.w2v.gensim_model.wv.get_vector(medic) if medic in self.w2v.gensim_model.wv.index2entity else np.zeros(self.w2v_embedding_dim) for medic in seq] if len(seq) > 0 else [] for seq in batch_w2v]
-		# Pad the sequences with zeros up to the sequence length.
-		# Here it is SUPER important to indicate dtype='float32' otherwise the pad_sequences
-		# function will transform everything into integers
-		transformed_w2v = keras.preprocessing.sequence.pad_sequences(transformed_w2v, maxlen=self.sequence_length, dtype='float32')
-		X['w2v_input']=transformed_w2v
-		# Transform the active meds, pharmacological classes and department into a multi-hot vector
-		# Get batches
-		batch_am = self.X_am[idx * self.batch_size:(idx+1) * self.batch_size]
-		batch_depa = self.X_depa[idx * self.batch_size:(idx+1) * self.batch_size]
-		# Prepare the batches for input into the ColumnTransformer step of the pipeline
-		batch_pse = [[bm, bd] for bm, bd in zip(batch_am, batch_depa)]
-		# Transform
-		transformed_pse = self.pse.transform(batch_pse)
+		X['w2v_input'] = self.transform_w2v(batch_indices)
 		# Output of the pipeline is a sparse matrix, convert to dense
-		X['pse_input']=transformed_pse.todense()
+		X['pse_input'] = self.transform_pse(batch_indices).todense()
 		# Target
 		if self.return_targets:
-			# Get a batch
-			batch_y = self.y[idx * self.batch_size:(idx+1) * self.batch_size]
-			# Transform the batch
-			transformed_y = self.le.transform(batch_y)
-			y = {'main_output': transformed_y}
+			y = {'main_output': self.transform_targets(batch_indices)}
 			return X, y
 		else:
 			return X
+
+	def transform_w2v(self, batch_indices):
+		# Transform the sequence into word2vec embeddings
+		# Get a batch
+		batch_w2v = [self.X_w2v[i] for i in batch_indices]
+		# Pad the sequences of embedding ids, then look them up in the
+		# embedding matrix (zeros for padding and unknown medications)
+		return self.embedding_matrix[self.w2v_ids(batch_w2v)]
+
+	def w2v_ids(self, seqs):
+		# Convert the sequences to embedding ids padded and truncated
+		# at the beginning up to the sequence length.
+		out = np.zeros((len(seqs), self.sequence_length), dtype=np.int32)
+		# Truncate and get the ids of all medications in one flat array
+		truncated = [seq[-self.sequence_length:] for seq in seqs]
+		lengths = np.array([len(seq) for seq in truncated], dtype=np.int64)
+		offsets = np.cumsum(lengths) - lengths
+		flat_ids = np.fromiter((self.token2id.get(medic, 0) for seq in truncated for medic in seq), dtype=np.int32, count=lengths.sum())
+		pad_ids(flat_ids, lengths, offsets, out)
+		return out
+
+	def transform_pse(self, batch_indices):
+		# Transform the active meds, pharmacological classes and department into a multi-hot vector
+		# Get batches
+		batch_am = [self.X_am[i] for i in batch_indices]
+		batch_depa = [self.X_depa[i] for i in batch_indices]
+		# Prepare the batches for input into the ColumnTransformer step of the pipeline
+		batch_pse = pse_helper_functions().pse_array(batch_am, batch_depa)
+		# Transform
+		return self.pse.transform(batch_pse)
+
+	def transform_targets(self, batch_indices):
+		# Get a batch
+		batch_y = [self.y[i] for i in batch_indices]
+		# Transform the batch
+		return self.le.transform(batch_y)
 	
 	def on_epoch_end(self):
 		# Shuffle after each training epoch so that the data is not always
@@ -255,6 +308,186 @@ class TransformedGenerator(keras.utils.Sequence):
 			random.shuffle(shuffled)
 			self.y, self.X_w2v, self.X_am, self.X_depa = zip(*shuffled)
 
+	def encode_w2v(self):
+		# Convert the sequences to a single contiguous array of embedding ids
+		X_w2v_ids = self.w2v_ids(self.X_w2v)
+		return self.embedding_matrix, X_w2v_ids
+
+	def quantize_embeddings(self, embedding_matrix):
+		# Quantize the embeddings to int8 with one scale per row, the
+		# padding row of zeros keeps a scale of 0.
+		scale = np.abs(embedding_matrix).max(axis=1, keepdims=True) / 127
+		quantized = np.round(np.divide(embedding_matrix, scale, out=np.zeros_like(embedding_matrix), where=scale > 0)).astype(np.int8)
+		return quantized, scale.astype(np.float32)
+
+	def precompute(self, save_path=None, quantize_embeddings=False):
+		# Transform the whole dataset once into arrays and return them
+		# as a TransformedDataset, saved in save_path if provided so that
+		# they can be loaded back without the fitted pipelines.
+		n_samples = len(self.X_w2v)
+		# The sequences become embedding ids looked up in the embedding matrix.
+		print('Transforming sequences...')
+		embedding_matrix, X_w2v_ids = self.encode_w2v()
+		# The embeddings can be quantized to int8 to read 4 times less
+		# memory at each lookup
+		embedding_scale = None
+		if quantize_embeddings:
+			embedding_matrix, embedding_scale = self.quantize_embeddings(embedding_matrix)
+		# The multi-hot vectors of the whole dataset are transformed in a
+		# single call to the PSE.
+		print('Transforming profile states...')
+		pse_X = self.transform_pse(range(n_samples)).tocsr()
+		y = None
+		if self.return_targets:
+			print('Transforming targets...')
+			y = np.asarray(self.transform_targets(range(n_samples)), dtype=np.int32)
+		transformed = TransformedDataset(self.batch_size, shuffle=self.shuffle, embedding_matrix=embedding_matrix, embedding_scale=embedding_scale, X_w2v_ids=X_w2v_ids, pse_X=pse_X, y=y, token2id=self.token2id, classes=self.le.classes_)
+		if save_path is not None:
+			print('Saving transformed data...')
+			transformed.save(save_path)
+		return transformed
+
+
+class TransformedDataset:
+
+	'''
+	This is the tf.data counterpart of TransformedGenerator. It takes the data transformed
+	once into arrays (by TransformedGenerator.precompute or loaded back from the files it
+	saved) and builds a pipeline where the batches are assembled with tensorflow ops only.
+	Loading the saved arrays does not need the fitted scikit-learn pipelines.
+	'''
+
+	def __init__(self, batch_size, shuffle=True, embedding_matrix=None, embedding_scale=None, X_w2v_ids=None, pse_X=None, y=None, token2id=None, classes=None):
+		# Training hyperparameters
+		self.batch_size = batch_size
+		# Do you want to shuffle ? True if you train, False if you evaluate
+		self.shuffle = shuffle
+		# Embedding matrix (int8 if quantized, with one float32 scale per row)
+		self.embedding_matrix = embedding_matrix
+		self.embedding_scale = embedding_scale
+		# Data (targets are a contiguous int32 array, None if you're predicting)
+		self.X_w2v_ids = X_w2v_ids
+		self.pse_X = pse_X
+		self.y = y
+		# Encoders of the medications and the targets
+		self.token2id = token2id
+		self.classes = classes
+
+	def save(self, save_path):
+		# The embeddings and the sequences of embedding ids are saved as
+		# .npy files.
+		np.save(os.path.join(save_path, 'w2v_ids.npy'), self.X_w2v_ids)
+		np.save(os.path.join(save_path, 'w2v_embeddings.npy'), self.embedding_matrix)
+		if self.embedding_scale is not None:
+			np.save(os.path.join(save_path, 'w2v_scale.npy'), self.embedding_scale)
+		sparse.save_npz(os.path.join(save_path, 'pse.npz'), self.pse_X)
+		# The other arrays go in a single file, saved last so that
+		# its presence means that all the files were saved.
+		artifacts = {
+			'token2id_keys': np.array(list(self.token2id.keys())),
+			'token2id_vals': np.array(list(self.token2id.values()), dtype=np.int32),
+			'classes': self.classes,
+			# Transformation parameters, to check that the saved data
+			# can be reused (see matches)
+			'sequence_length': self.X_w2v_ids.shape[1],
+			'w2v_embedding_dim': self.embedding_matrix.shape[1],
+			'quantized': self.embedding_scale is not None,
+			}
+		if self.y is not None:
+			artifacts['y'] = self.y
+		np.savez(os.path.join(save_path, 'artifacts.npz'), **artifacts)
+
+	def matches(self, save_path, sequence_length, w2v_embedding_dim, quantized):
+		# Check that the data saved in save_path was transformed with the
+		# same parameters, in which case it can be loaded back instead of
+		# being transformed again.
+		artifacts_file = os.path.join(save_path, 'artifacts.npz')
+		if not os.path.isfile(artifacts_file):
+			return False
+		artifacts = np.load(artifacts_file)
+		saved = {key: artifacts[key].item() for key in ['sequence_length', 'w2v_embedding_dim', 'quantized'] if key in artifacts.files}
+		expected = {'sequence_length': sequence_length, 'w2v_embedding_dim': w2v_embedding_dim, 'quantized': bool(quantized)}
+		if saved != expected:
+			print('Saved transformed data does not match the transformation parameters (saved: {}, expected: {}), it will be transformed again.'.format(saved, expected))
+			return False
+		return True
+
+	def load(self, save_path):
+		artifacts = np.load(os.path.join(save_path, 'artifacts.npz'))
+		self.token2id = dict(zip(artifacts['token2id_keys'].tolist(), artifacts['token2id_vals'].tolist()))
+		self.classes = artifacts['classes']
+		self.y = artifacts['y'].astype(np.int32, copy=False) if 'y' in artifacts.files else None
+		self.embedding_matrix = np.load(os.path.join(save_path, 'w2v_embeddings.npy'))
+		if artifacts['quantized']:
+			self.embedding_scale = np.load(os.path.join(save_path, 'w2v_scale.npy'))
+		else:
+			self.embedding_scale = None
+		self.X_w2v_ids = np.load(os.path.join(save_path, 'w2v_ids.npy'))
+		self.pse_X = sparse.load_npz(os.path.join(save_path, 'pse.npz')).tocsr()
+
+	def as_dataset(self):
+		# Build a tf.data pipeline where only the batch indices flow
+		# through the dataset and the transformation is mapped over them
+		# on several threads, so that the next batches are prepared while
+		# the model trains on the current one.
+		n_samples, pse_shape = self.pse_X.shape
+		quantized = self.embedding_scale is not None
+		return_targets = self.y is not None
+		# The multi-hot vectors are kept as the column indices of each
+		# row of the sparse matrix.
+		self.pse_X.sort_indices()
+		pse_rows = tf.RaggedTensor.from_row_splits(self.pse_X.indices.astype(np.int64), self.pse_X.indptr.astype(np.int64))
+		# The other arrays are also converted to tensors once here, so
+		# that the mapped function captures them as inputs instead of
+		# embedding a copy of them as constants in its graph.
+		w2v_ids = tf.convert_to_tensor(self.X_w2v_ids)
+		embedding_matrix = tf.convert_to_tensor(self.embedding_matrix)
+		if quantized:
+			embedding_scale = tf.convert_to_tensor(self.embedding_scale)
+		if return_targets:
+			y = tf.convert_to_tensor(self.y)
+		dataset = tf.data.Dataset.range(n_samples)
+		# Shuffling the indices replaces on_epoch_end, which Keras
+		# does not call for a tf.data.Dataset
+		if self.shuffle == True:
+			dataset = dataset.shuffle(n_samples, reshuffle_each_iteration=True)
+		# Batch the indices before mapping so that the transformation
+		# is called once per batch instead of once per sample
+		dataset = dataset.batch(self.batch_size)
+
+		def gather_pse(batch_indices):
+			# Gather the rows of the batch and scatter them into a dense
+			# multi-hot matrix (the encoder is binary, all values are 1)
+			batch_rows = tf.gather(pse_rows, batch_indices)
+			batch_pse = tf.SparseTensor(
+				indices=tf.stack([batch_rows.value_rowids(), batch_rows.flat_values], axis=1),
+				values=tf.ones_like(batch_rows.flat_values, dtype=tf.float32),
+				dense_shape=[tf.size(batch_indices, out_type=tf.int64), pse_shape])
+			return tf.sparse.to_dense(batch_pse)
+
+		def lookup_w2v(batch_indices):
+			batch_ids = tf.gather(w2v_ids, batch_indices)
+			if quantized:
+				# Dequantize only the looked up rows
+				return tf.cast(tf.nn.embedding_lookup(embedding_matrix, batch_ids), tf.float32) * tf.nn.embedding_lookup(embedding_scale, batch_ids)
+			return tf.nn.embedding_lookup(embedding_matrix, batch_ids)
+
+		def tf_transform(batch_indices):
+			X = {
+				'w2v_input': lookup_w2v(batch_indices),
+				'pse_input': gather_pse(batch_indices),
+				}
+			if return_targets:
+				return X, {'main_output': tf.gather(y, batch_indices)}
+			return X
+
+		dataset = dataset.map(tf_transform, num_parallel_calls=tf.data.AUTOTUNE)
+		# If a GPU is available, copy the next batches to it while the
+		# current one is processed. This must be the last transformation.
+		if tf.config.list_physical_devices('GPU'):
+			return dataset.apply(tf.data.experimental.prefetch_to_device('/gpu:0', buffer_size=2))
+		return dataset.prefetch(tf.data.AUTOTUNE)
+
 
 class neural_network:
 
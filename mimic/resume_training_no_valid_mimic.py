@@ -14,14 +14,10 @@ from multiprocessing import cpu_count
 import joblib
 import pandas as pd
 import tensorflow as tf
-from gensim.sklearn_api import W2VTransformer
-from sklearn.compose import ColumnTransformer
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import LabelEncoder
 
-from components_mimic import (TransformedGenerator, check_ipynb, data,
-                        neural_network, pse_helper_functions, visualization)
+from components_mimic import (TransformedDataset, TransformedGenerator,
+                        check_ipynb, data, neural_network,
+                        pse_helper_functions, visualization)
 
 #%%[markdown]
 # ## Global variables
@@ -37,6 +33,29 @@ from components_mimic import (TransformedGenerator, check_ipynb, data,
 SAVE_DIR = '20190813-2105training'
 save_path = os.path.join('mimic', 'model', SAVE_DIR)
 
+#%%[markdown]
+# ### Training options
+#
+# JIT_COMPILE compiles the training step with XLA, fusing the
+# operations of the network into fewer kernels. It is ignored for
+# models trained on GPU, which use CuDNNLSTM layers that XLA cannot
+# compile.
+# MIXED_PRECISION_POLICY sets the Keras mixed precision policy used
+# to resume training ('mixed_bfloat16' on devices that support bfloat16,
+# or 'mixed_float16'). None trains in float32. It is ignored for models
+# trained on GPU, the CuDNNLSTM layers have no reduced precision kernel,
+# and with Tensorflow 2.11 or later, where the optimizer state cannot
+# be copied to the mixed precision model (see below).
+# The models saved with a mixed policy need Tensorflow 2.4 or later to
+# be loaded (for example by evaluate_mimic.py).
+# QUANTIZE_EMBEDDINGS stores the word2vec embeddings looked up by the
+# input pipeline in int8 with one scale per embedding.
+
+#%%
+JIT_COMPILE = True
+MIXED_PRECISION_POLICY = None
+QUANTIZE_EMBEDDINGS = False
+
 #%%[markdown]
 # ## Execution
 
@@ -51,7 +70,14 @@ in_ipynb = check_ipynb().is_inipynb()
 #%%[markdown]
 # ### Data
 #
-# Load the data to resume the training
+# Load the data to resume the training.
+#
+# The first time training is resumed, the data is transformed with the
+# previously fitted pipelines and the transformed arrays are saved in
+# save_path. When resuming again, these arrays are loaded back directly
+# without loading the raw data and the fitted pipelines, unless they
+# were transformed with another sequence length, embedding dimension
+# or QUANTIZE_EMBEDDINGS value.
 
 #%%[markdown]
 # #### Load the data
@@ -59,21 +85,25 @@ in_ipynb = check_ipynb().is_inipynb()
 #%%
 N_TRAINING_EPOCHS, BATCH_SIZE, SEQUENCE_LENGTH, W2V_EMBEDDING_DIM = joblib.load(os.path.join(save_path, 'hp.joblib'))
 
-d = data()
+transformed_available = TransformedDataset(BATCH_SIZE).matches(save_path, SEQUENCE_LENGTH, W2V_EMBEDDING_DIM, QUANTIZE_EMBEDDINGS)
 
-if os.path.isfile(os.path.join(save_path, 'sampled_encs.pkl')):
-	enc_file = os.path.join(save_path, 'sampled_encs.pkl')
-	print('Loaded partially completed experiment was done with RESTRICTED DATA !')
-else:
-	enc_file = False
+if not transformed_available:
+	d = data()
+
+	if os.path.isfile(os.path.join(save_path, 'sampled_encs.pkl')):
+		enc_file = os.path.join(save_path, 'sampled_encs.pkl')
+		print('Loaded partially completed experiment was done with RESTRICTED DATA !')
+	else:
+		enc_file = False
 
-d.load_data(previous_encs_path=enc_file, get_profiles=False)
+	d.load_data(previous_encs_path=enc_file, get_profiles=False)
 
 #%%[markdown]
 # #### Make the data lists
 
 #%%
-_, targets_train, seq_train, active_meds_train, depa_train, _, _, _, _ = d.make_lists(get_valid=False)
+if not transformed_available:
+	_, targets_train, seq_train, active_meds_train, depa_train, _, _, _, _ = d.make_lists(get_valid=False)
 
 #%%[markdown]
 # ### Word2vec embeddings
@@ -81,7 +111,8 @@ _, targets_train, seq_train, active_meds_train, depa_train, _, _, _, _ = d.make_
 # Load the previously fitted word2vec pipeline
 
 #%%
-w2v = joblib.load(os.path.join(save_path, 'w2v.joblib'))
+if not transformed_available:
+	w2v = joblib.load(os.path.join(save_path, 'w2v.joblib'))
 
 #%%[markdown]
 # ### Profile state encoder (PSE)
@@ -89,11 +120,12 @@ w2v = joblib.load(os.path.join(save_path, 'w2v.joblib'))
 # Load the previously fitted profile state encoder
 
 #%%
-phf = pse_helper_functions()
-pse_pp = phf.pse_pp
-pse_a = phf.pse_a
+if not transformed_available:
+	phf = pse_helper_functions()
+	pse_pp = phf.pse_pp
+	pse_a = phf.pse_a
 
-pse = joblib.load(os.path.join(save_path, 'pse.joblib'))
+	pse = joblib.load(os.path.join(save_path, 'pse.joblib'))
 
 #%%[markdown]
 # ### Label encoder
@@ -101,7 +133,8 @@ pse = joblib.load(os.path.join(save_path, 'pse.joblib'))
 # Load the previously fitted label encoder
 
 #%%
-le = joblib.load(os.path.join(save_path, 'le.joblib'))
+if not transformed_available:
+	le = joblib.load(os.path.join(save_path, 'le.joblib'))
 
 #%%[markdown]
 # ### Neural network
@@ -116,19 +149,22 @@ with open(os.path.join(save_path, 'done_epochs.pkl'), mode='rb') as file:
 	N_DONE_EPOCHS = pickle.load(file)
 
 #%%[markdown]
-# Get the variables necessary to train the model from
-# the fitted scikit-learn pipelines.
-
-#%%
-w2v_step = w2v.named_steps['w2v']
-pse_shape = sum([len(transformer[1].vocabulary_) for transformer in pse.named_steps['columntrans'].transformers_])
-output_n_classes = len(le.classes_)
-
-#%%[markdown]
-# #### Sequence generators
+# #### Input pipeline
+#
+# Transform the data (or load the data transformed when training
+# was previously resumed) into a tf.data pipeline that prefetches
+# batches while the model trains.
 
 #%%
-train_generator = TransformedGenerator(w2v_step, pse, le, targets_train, seq_train, active_meds_train, depa_train, W2V_EMBEDDING_DIM, SEQUENCE_LENGTH, BATCH_SIZE)
+if transformed_available:
+	print('Loading data transformed when training was previously resumed...')
+	transformed = TransformedDataset(BATCH_SIZE)
+	transformed.load(save_path)
+else:
+	w2v_step = w2v.named_steps['w2v']
+	train_generator = TransformedGenerator(w2v_step, pse, le, targets_train, seq_train, active_meds_train, depa_train, W2V_EMBEDDING_DIM, SEQUENCE_LENGTH, BATCH_SIZE)
+	transformed = train_generator.precompute(save_path=save_path, quantize_embeddings=QUANTIZE_EMBEDDINGS)
+train_dataset = transformed.as_dataset()
 
 #%%[markdown]
 # #### Instantiate the model
@@ -137,6 +173,57 @@ train_generator = TransformedGenerator(w2v_step, pse, le, targets_train, seq_tra
 n = neural_network()
 callbacks = n.callbacks(save_path, callback_mode='train_no_valid', n_done_epochs=N_DONE_EPOCHS)
 model = tf.keras.models.load_model(os.path.join(save_path, 'partially_trained_model.h5'), custom_objects={'sparse_top10_accuracy':n.sparse_top10_accuracy, 'sparse_top30_accuracy':n.sparse_top30_accuracy})
+# Models trained on GPU use CuDNNLSTM layers (see define_model)
+has_cudnn_lstm = any(layer.__class__.__name__ == 'CuDNNLSTM' for layer in model.layers)
+
+#%%[markdown]
+# Apply the mixed precision policy. The layers of a loaded model keep
+# the dtype they were saved with, so the model is cloned with the
+# policy applied to each layer and the weights are copied over. The
+# output layer is kept in float32 so that the softmax, the loss and
+# the top k accuracy metrics are computed in full precision.
+# The cloned model has new variables, so the moments of the optimizer
+# are created for them and the saved moments are copied over (the
+# variables are in the same order) to resume with the same state.
+# This uses the optimizer API of Tensorflow 2.5 to 2.10 (replaced in
+# Tensorflow 2.11), without it the model is trained in float32.
+
+#%%
+optimizer = model.optimizer
+optimizer_state_copyable = all(hasattr(optimizer, attr) for attr in ['_create_all_weights', 'get_weights', 'set_weights'])
+if MIXED_PRECISION_POLICY is not None and has_cudnn_lstm:
+	print('The model uses CuDNNLSTM layers that do not support mixed precision, training in float32...')
+elif MIXED_PRECISION_POLICY is not None and not optimizer_state_copyable:
+	print('The optimizer state cannot be copied to a mixed precision model with this version of Tensorflow (2.5 to 2.10 required), training in float32...')
+elif MIXED_PRECISION_POLICY is not None:
+	tf.keras.mixed_precision.set_global_policy(MIXED_PRECISION_POLICY)
+
+	def apply_policy(layer):
+		config = layer.get_config()
+		if layer.name != 'main_output':
+			config['dtype'] = MIXED_PRECISION_POLICY
+		return layer.__class__.from_config(config)
+
+	mixed_model = tf.keras.models.clone_model(model, clone_function=apply_policy)
+	mixed_model.set_weights(model.get_weights())
+	optimizer = model.optimizer.__class__.from_config(model.optimizer.get_config())
+	optimizer._create_all_weights(mixed_model.trainable_variables)
+	optimizer.set_weights(model.optimizer.get_weights())
+	model = mixed_model
+
+#%%[markdown]
+# Recompile the model with the same optimizer (to keep its state),
+# loss and metrics, using XLA if enabled and the model has no
+# CuDNNLSTM layers.
+# The loss takes the int32 encoded targets directly (the output
+# layer already applies the softmax, so it does not take logits).
+# The custom metrics are compiled with the rest of the training step.
+
+#%%
+if JIT_COMPILE and has_cudnn_lstm:
+	print('The model uses CuDNNLSTM layers that XLA cannot compile, training without XLA...')
+loss = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=False, reduction=tf.keras.losses.Reduction.SUM_OVER_BATCH_SIZE)
+model.compile(optimizer=optimizer, loss=loss, metrics=['sparse_categorical_accuracy', n.sparse_top10_accuracy, n.sparse_top30_accuracy], jit_compile=(JIT_COMPILE and not has_cudnn_lstm))
 
 #%%[markdown]
 # #### Resume training the model
@@ -153,7 +240,7 @@ if in_ipynb:
 else:
 	verbose=1
 
-model.fit_generator(train_generator,
+model.fit(train_dataset,
 	epochs=(N_TRAINING_EPOCHS-N_DONE_EPOCHS),
 	callbacks=callbacks,
 	verbose=verbose)
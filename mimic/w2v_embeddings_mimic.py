@@ -12,16 +12,20 @@ from datetime import datetime
 from multiprocessing import cpu_count
 
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import scikitplot as skplt
 import seaborn as sns
 import umap
 from gensim.sklearn_api import W2VTransformer
+from joblib import Parallel, delayed
 from mpl_toolkits import mplot3d
+from scipy.cluster.hierarchy import fcluster, linkage
 from sklearn import metrics
-from sklearn.cluster import AgglomerativeClustering
+from sklearn.base import clone
 from sklearn.metrics import silhouette_score
-from sklearn.model_selection import GridSearchCV, cross_validate
+from sklearn.metrics.pairwise import cosine_distances
+from sklearn.model_selection import ParameterGrid, cross_validate
 from sklearn.pipeline import Pipeline
 
 from components_mimic import check_ipynb
@@ -45,7 +49,13 @@ pathlib.Path(SAVE_PATH).mkdir(parents=True, exist_ok=True)
 # ### Word2vec hyperparameters
 #
 # #### Grid search hyperparameters
-# This grid will be used when performing grid search
+# This grid will be used when performing grid search.
+# Each configuration is trained with gensim's multithreaded trainer
+# on all cores but one instead of training several configurations
+# in parallel, which would copy the data to each process.
+# Each configuration is trained once on the whole data and scored
+# on the analogies, without cross-validation: the analogies do not
+# depend on the data splits.
 
 #%%
 W2V_GRID = {
@@ -55,20 +65,43 @@ W2V_GRID = {
 			'w2v__hs': [0,1],
 			'w2v__sg': [0,1],
 			'w2v__min_count': [5],
-			'w2v__workers':[1],
+			'w2v__workers':[max(1, cpu_count()-1)],
 			}
 
 #%%[markdown]
 # ### Clustering hyperparameters
 #
 # #### Grid search hyperparameters
-# This grid will be used when performing grid search
+# This grid will be used when performing grid search.
+# The hierarchical clustering tree is computed once and then cut
+# at each number of clusters.
 
 #%%
 CLUST_GRID = {
 			'ac__n_clusters': [5,6,7,8,9,10,11,12,13,14,15],
 			}
 
+#%%[markdown]
+# #### UMAP hyperparameters
+# These are used to project the embeddings in 3D before clustering.
+# All cores are used for the nearest neighbors search and fewer
+# optimization epochs than the default are run, which is enough
+# to feed the clustering.
+# FINAL_UMAP_PARAMS are used to project the embeddings again for the
+# final 3d plot and graph_dataframe.csv, for example {'n_components': 3}
+# for a default quality projection. If None, the projection used for
+# the clustering is reused.
+
+#%%
+UMAP_PARAMS = {
+			'n_components': 3,
+			'n_jobs': -1,
+			'n_epochs': 100,
+			'low_memory': False,
+			'init': 'random',
+			}
+FINAL_UMAP_PARAMS = None
+
 #%%[markdown]
 # ## Data
 #
@@ -85,7 +118,7 @@ print('Data successfully loaded.')
 #%%[markdown]
 # ## Transformers
 #
-# Prepare the word2vec and clustering transformers
+# Prepare the word2vec transformer
 
 #%%[markdown]
 # ### Word2vec transformer
@@ -95,34 +128,63 @@ w2v_pipe = Pipeline([
 			('w2v', W2VTransformer()),
 			])
 
-#%%[markdown]
-# ### Clustering transformer
-
-#%%
-clust_pipe = Pipeline([
-			('ac', AgglomerativeClustering()),
-			])
-
 #%%[markdown]
 # ## Helper functions 
 #
-# These are scoring functions that will be used to score
-# the word2vec embeddings and the clustering of the embeddings.
+# These are the functions that will be used to fit and score
+# the word2vec embeddings.
 
 #%%
 in_ipynb = check_ipynb().is_inipynb()
 
+# Parse the analogy file once instead of at each scoring.
+# YOUR ANALOGY FILE HERE, see https://radimrehurek.com/gensim/models/keyedvectors.html#gensim.models.keyedvectors.WordEmbeddingsKeyedVectors.accuracy for specifications.
+# Sections are ignored, words are uppercased to compare them case insensitively like gensim does.
+with open('mimic/data/eval_analogy.txt', mode='r') as file:
+	analogies = [line.upper().split() for line in file if not line.startswith(':')]
+analogies = [analogy for analogy in analogies if len(analogy) == 4]
+
 def accuracy_scorer_gensim(pipe, X=None, y=None):
-	acc_dict = pipe.named_steps['w2v'].gensim_model.wv.accuracy('mimic/data/eval_analogy.txt') # YOUR ANALOGY FILE HERE, see https://radimrehurek.com/gensim/models/keyedvectors.html#gensim.models.keyedvectors.WordEmbeddingsKeyedVectors.accuracy for specifications.
-	accuracy = len(acc_dict[1]['correct'])/((len(acc_dict[1]['correct'])) + (len(acc_dict[1]['incorrect'])))
+	# Reimplements the gensim accuracy evaluation, scoring all the
+	# analogies at once with a single matrix product.
+	wv = pipe.named_steps['w2v'].gensim_model.wv
+	# Like gensim, restrict the vocabulary to the 30000 most frequent
+	# words and keep the most frequent word for each uppercased word
+	index2entity = wv.index2entity[:30000]
+	upper2index = dict()
+	for i, entity in enumerate(index2entity):
+		upper2index.setdefault(entity.upper(), i)
+	entity_ids = np.array([upper2index[entity.upper()] for entity in index2entity])
+	# Keep only the analogies where all words are in the vocabulary
+	questions = np.array([[upper2index[word] for word in analogy] for analogy in analogies if all(word in upper2index for word in analogy)], dtype=np.int64).reshape(-1, 4)
+	if len(questions) == 0:
+		print('No analogy found in vocabulary, accuracy is 0')
+		return 0
+	# Normalize the embeddings
+	vectors = wv.vectors[:len(index2entity)]
+	vectors_norm = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+	# Cosine similarity between b - a + c and the whole vocabulary
+	queries = vectors_norm[questions[:, 1]] - vectors_norm[questions[:, 0]] + vectors_norm[questions[:, 2]]
+	sims = np.dot(queries, vectors_norm.T)
+	# The words of the question cannot be the answer
+	for j in range(3):
+		sims[entity_ids[np.newaxis, :] == questions[:, j, np.newaxis]] = -np.inf
+	predicted = entity_ids[np.argmax(sims, axis=1)]
+	accuracy = np.mean(predicted == questions[:, 3])
 	print('Accuracy is : {:.3f}'.format(accuracy))
 	return accuracy
 
-def silhouette_scorer_cosine(pipe, X=None, y=None):
-	clusters = pipe.named_steps['ac'].fit_predict(X)
-	score = silhouette_score(X, clusters, metric='cosine')
-	print('Score is: {}'.format(score))
-	return score
+def fit_score_w2v(params, data):
+	# Return only the score so that the fitted models are not kept
+	# in memory, a failing configuration gets a score of 0 (like
+	# error_score=0 in GridSearchCV) instead of stopping the search
+	try:
+		pipe = clone(w2v_pipe).set_params(**params)
+		pipe.fit(data)
+		return accuracy_scorer_gensim(pipe)
+	except Exception as e:
+		print('Fitting failed for {}: {}, accuracy is 0'.format(params, e))
+		return 0
 
 #%%[markdown]
 # ## Word2vec grid search
@@ -131,27 +193,39 @@ def silhouette_scorer_cosine(pipe, X=None, y=None):
 
 #%%
 print('Performing grid search for word2vec embeddings...')
-w2v_gscv = GridSearchCV(w2v_pipe, W2V_GRID, scoring={'acc':accuracy_scorer_gensim}, cv=3, refit='acc', error_score=0, return_train_score=False, n_jobs=-2, verbose=1) # n_jobs=-2 otherwise is too cpu intensive and hangs the machine
-w2v_gscv.fit(data)
+w2v_param_grid = list(ParameterGrid(W2V_GRID))
+# Run as many configurations in parallel as the cores allow given
+# the number of gensim workers (usually one at a time)
+n_jobs = max(1, cpu_count() // min(W2V_GRID['w2v__workers']))
+w2v_scores = Parallel(n_jobs=n_jobs, backend='loky', verbose=1)(delayed(fit_score_w2v)(params, data) for params in w2v_param_grid)
+# Refit the best configuration only
+best_index = int(np.argmax(w2v_scores))
+w2v_best_params = w2v_param_grid[best_index]
+print('Refitting the best word2vec configuration...')
+w2v_best_pipe = clone(w2v_pipe).set_params(**w2v_best_params)
+w2v_best_pipe.fit(data)
 
 # Convert results to a dataframe and save it
 print('Saving results of grid search for word2vec embeddings...')
-w2v_gscv_results_df = pd.DataFrame.from_dict(w2v_gscv.cv_results_)
-w2v_gscv_results_df.to_csv(os.path.join(SAVE_PATH,'word2vec_gridsearch_results.csv'))
+w2v_results_df = pd.DataFrame({'params': w2v_param_grid, 'mean_test_acc': w2v_scores})
+for param in W2V_GRID:
+	w2v_results_df['param_' + param] = [params[param] for params in w2v_param_grid]
+w2v_results_df['rank_test_acc'] = w2v_results_df['mean_test_acc'].rank(ascending=False, method='min').astype(int)
+w2v_results_df.to_csv(os.path.join(SAVE_PATH,'word2vec_gridsearch_results.csv'))
 # Sort by rank
-w2v_gscv_results_df.set_index('rank_test_acc', inplace=True)
+w2v_results_df.set_index('rank_test_acc', inplace=True)
 # Select only useful columns
-w2v_gscv_results_filtered = w2v_gscv_results_df[['split0_test_acc', 'split1_test_acc', 'split2_test_acc']].copy()
+w2v_results_filtered = w2v_results_df[['mean_test_acc']].copy()
 # Rename columns to clearer names
-w2v_gscv_results_filtered.rename(inplace=True, index=str, columns={'split0_test_acc': 'Test analogy score', 'split1_test_acc': 'Test analogy score', 'split2_test_acc': 'Test analogy score'})
+w2v_results_filtered.rename(inplace=True, index=str, columns={'mean_test_acc': 'Analogy score'})
 # Structure the dataframe as expected by Seaborn
-w2v_gscv_results_graph_df = w2v_gscv_results_filtered.stack().reset_index()
-w2v_gscv_results_graph_df.rename(inplace=True, index=str, columns={'rank_test_acc':'Rank', 'level_1':'Metric', 0:'Result'})
+w2v_results_graph_df = w2v_results_filtered.stack().reset_index()
+w2v_results_graph_df.rename(inplace=True, index=str, columns={'rank_test_acc':'Rank', 'level_1':'Metric', 0:'Result'})
 # Make sure the epochs are int to avoid weird ordering effects in the plot
-w2v_gscv_results_graph_df['Rank'] = w2v_gscv_results_graph_df['Rank'].astype('int8')
+w2v_results_graph_df['Rank'] = w2v_results_graph_df['Rank'].astype('int8')
 # Plot
 sns.set(style='darkgrid')
-sns.relplot(x='Rank', y='Result', hue='Metric', kind='line', data=w2v_gscv_results_graph_df)
+sns.relplot(x='Rank', y='Result', hue='Metric', kind='line', data=w2v_results_graph_df)
 # Output the plot
 if in_ipynb:
 	plt.show()
@@ -168,35 +242,44 @@ plt.gcf().clear()
 
 #%%
 print('Reducing dimensionality of word2vec embeddings for clustering...')
-# Get the normalized word2vec embeddings
-w2v_gscv.best_estimator_.named_steps['w2v'].gensim_model.init_sims(replace=True)
-vectors = w2v_gscv.best_estimator_.named_steps['w2v'].gensim_model.wv.vectors
-# Reduce dimensionality to 3D using UMAP
-umapper = umap.UMAP(n_components=3)
-umap_vectors = umapper.fit_transform(vectors)
+# Get the normalized word2vec embeddings, the original vectors
+# in the model are kept as is (unlike with init_sims(replace=True))
+vectors = w2v_best_pipe.named_steps['w2v'].gensim_model.wv.vectors
+unit_vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+# Reduce dimensionality to 3D using UMAP, the projection is reused
+# for the final embeddings
+umapper = umap.UMAP(**UMAP_PARAMS)
+umap_vectors = umapper.fit_transform(unit_vectors)
 
 #%%
 # Do the clustering
+# Compute the Ward linkage tree once (like AgglomerativeClustering
+# does), then cut it at each number of clusters of the grid.
+# fcluster numbers the clusters from 1, 1 is subtracted to number
+# them from 0 like AgglomerativeClustering.
 print('Performing grid search for clustering...')
-clust_gscv = GridSearchCV(clust_pipe, CLUST_GRID, scoring={'sil':silhouette_scorer_cosine}, cv=3, refit='sil', error_score=0, return_train_score=False, n_jobs=-2, verbose=1) # n_jobs=-2 otherwise is too cpu intensive and hangs the machine
-clust_gscv.fit(umap_vectors)
+linkage_matrix = linkage(umap_vectors, method='ward')
+# Compute the cosine distances once for all silhouette scores
+umap_distances = cosine_distances(umap_vectors)
+clust_results = []
+for n_clusters in CLUST_GRID['ac__n_clusters']:
+	clusters = fcluster(linkage_matrix, t=n_clusters, criterion='maxclust') - 1
+	score = silhouette_score(umap_distances, clusters, metric='precomputed')
+	print('Score for {} clusters is: {}'.format(n_clusters, score))
+	clust_results.append([n_clusters, score])
 
 # Convert results to a dataframe and save it
 print('Saving results of grid search for clustering...')
-clust_cv_results_df = pd.DataFrame.from_dict(clust_gscv.cv_results_)
-clust_cv_results_df.to_csv(os.path.join(SAVE_PATH, 'clustering_grid_search_results.csv'))
-# You want this to be sorted by number of clusters otherwise weird plot
-clust_cv_results_df.sort_values(by='param_ac__n_clusters', inplace=True)
-# Select only useful columns
-clust_cv_results_filtered = clust_cv_results_df[['param_ac__n_clusters', 'split0_test_sil', 'split1_test_sil', 'split2_test_sil']].copy()
-# Rename columns to clearer names
-clust_cv_results_filtered.rename(inplace=True, index=str, columns={'split0_test_sil': 'Test silhouette', 'split1_test_sil': 'Test silhouette', 'split2_test_sil': 'Test silhouette', 'param_ac__n_clusters':'k'})
+clust_results_df = pd.DataFrame(data=clust_results, columns=['k', 'Silhouette'])
+clust_results_df.to_csv(os.path.join(SAVE_PATH, 'clustering_grid_search_results.csv'))
+# Get the best number of clusters
+best_n_clusters = clust_results_df.loc[clust_results_df['Silhouette'].idxmax(), 'k']
 # Structure the dataframe as expected by Seaborn
-clust_cv_results_graph_df = clust_cv_results_filtered.set_index('k').stack().reset_index()
-clust_cv_results_graph_df.rename(inplace=True, index=str, columns={'level_1':'Metric', 0:'Result'})
+clust_results_graph_df = clust_results_df.set_index('k').stack().reset_index()
+clust_results_graph_df.rename(inplace=True, index=str, columns={'level_1':'Metric', 0:'Result'})
 # Plot
 sns.set(style='darkgrid')
-sns.relplot(x='k', y='Result', hue='Metric', kind='line', data=clust_cv_results_graph_df)
+sns.relplot(x='k', y='Result', hue='Metric', kind='line', data=clust_results_graph_df)
 # Output the plot
 if in_ipynb:
 	plt.show()
@@ -209,20 +292,15 @@ plt.gcf().clear()
 # ## Final embeddings
 
 # Get final accuracy
-acc = accuracy_scorer_gensim(w2v_gscv.best_estimator_)
-# Get the embeddings
-vectors = w2v_gscv.best_estimator_.named_steps['w2v'].gensim_model.wv.vectors
-# Reduce dimensionality for clustering and plotting
-print('Reducing dimensionality of final word2vec embeddings for clustering...')
-umapper = umap.UMAP(n_components=3)
-umap_vectors = umapper.fit_transform(vectors)
-# Cluster
+acc = accuracy_scorer_gensim(w2v_best_pipe)
+# Cluster the UMAP projection used in the clustering grid search
+# by cutting the same linkage tree at the best number of clusters
 print('Performing clustering...')
-clusters = clust_gscv.best_estimator_.fit_predict(umap_vectors)
+clusters = fcluster(linkage_matrix, t=best_n_clusters, criterion='maxclust') - 1
 
 # Plot the silhouette graph
 print('Plotting silhouette graph...')
-skplt.metrics.plot_silhouette(umap_vectors, clusters, metric='cosine')
+skplt.metrics.plot_silhouette(umap_distances, clusters, metric='precomputed')
 # Output the plot
 if in_ipynb:
 	plt.show()
@@ -232,14 +310,17 @@ else:
 plt.gcf().clear()
 
 # Plot the 3d clustered embeddings
-# Make a list of 3d coordinates and and associated cluster for each drug
+# Project the embeddings again for the plot if requested
+if FINAL_UMAP_PARAMS is not None:
+	print('Reducing dimensionality of word2vec embeddings for the final plot...')
+	final_umapper = umap.UMAP(**FINAL_UMAP_PARAMS)
+	final_umap_vectors = final_umapper.fit_transform(unit_vectors)
+else:
+	final_umap_vectors = umap_vectors
+# Make a dataframe of 3d coordinates and and associated cluster for each drug
 print('Plotting clustered 3d-UMAP projected embeddings...')
-graph_data = []
-index2entity = w2v_gscv.best_estimator_.named_steps['w2v'].gensim_model.wv.index2entity
-for umapcoords, cluster, entity in zip(umap_vectors, clusters, index2entity):
-	graph_data.append([umapcoords[0], umapcoords[1], umapcoords[2], cluster, entity])
-# Convert to dataframe
-graph_data_df = pd.DataFrame(data=graph_data, columns=['x', 'y', 'z', 'cluster', 'entity'])
+index2entity = w2v_best_pipe.named_steps['w2v'].gensim_model.wv.index2entity
+graph_data_df = pd.DataFrame({'x': final_umap_vectors[:, 0], 'y': final_umap_vectors[:, 1], 'z': final_umap_vectors[:, 2], 'cluster': clusters, 'entity': index2entity})
 # Save the dataframe (to eventually manually label clusters)
 graph_data_df.sort_values(by='cluster', inplace=True)
 graph_data_df.to_csv(os.path.join(SAVE_PATH, 'graph_dataframe.csv'))
@@ -261,6 +342,6 @@ else:
 plt.gcf().clear()
 
 #%%
-print('Best hyperparameters for word2vec embeddings: {}'.format(w2v_gscv.best_params_))
+print('Best hyperparameters for word2vec embeddings: {}'.format(w2v_best_params))
 
 #%%